@@ -43,7 +43,7 @@ class CustomSampler(torch.utils.data.Sampler):
         return len(self.indices)
     
 
-def get_data(dataset_name, batch_size, transform, shuffle=True, train_size=0.8, val_size=0.1, from_idx=0):
+def get_data(dataset_name, batch_size, transform, shuffle=True, train_size=0.8, val_size=0.1, from_idx=0, num_workers=0, pin_memory=False):
     """
     Loads the dataset and splits it into training, validation and test sets. Available datsets:
     ["cifar10", "cifar100", "imagenet_v2", "imagenet_a"]
@@ -53,6 +53,9 @@ def get_data(dataset_name, batch_size, transform, shuffle=True, train_size=0.8,
     :param shuffle: bool: shuffle the dataset
     :param train_size: float: proportion of the dataset to include in the training set
     :param val_size: float: proportion of the dataset to include in the validation set
+    :param num_workers: int: number of loading workers, kept alive across epochs when > 0. os.cpu_count()//2 is a good
+        value when the transform augments the images (Augmixer)
+    :param pin_memory: bool: load batches in pinned memory to allow non_blocking host to device copies
     :return: tuple: training, validation and test dataloaders
     """
     if dataset_name == "cifar10":
@@ -89,6 +92,11 @@ def get_data(dataset_name, batch_size, transform, shuffle=True, train_size=0.8,
     else:
         raise ValueError(f"Unknown dataset {dataset_name}")
     
+    loader_kwargs = dict(num_workers=num_workers, pin_memory=pin_memory)
+    if num_workers > 0:
+        # DataLoader seeds torch, numpy and random differently in every worker, the augmentations never repeat
+        loader_kwargs.update(persistent_workers=True)
+
     n = len(dataset)
     n_train = int(train_size * n)
     n_val = int(val_size * n)
@@ -98,15 +106,15 @@ def get_data(dataset_name, batch_size, transform, shuffle=True, train_size=0.8,
         train_loader, val_loader = None, None
         if batch_size == 1:
             test_loader = data.DataLoader(dataset, batch_size=batch_size, 
-                                          sampler=CustomSampler(range(n), from_idx=from_idx), collate_fn=my_collate)
+                                          sampler=CustomSampler(range(n), from_idx=from_idx), collate_fn=my_collate, **loader_kwargs)
         else:
             test_loader = data.DataLoader(dataset, batch_size=batch_size,
-                                          sampler=CustomSampler(range(n), from_idx=from_idx))
+                                          sampler=CustomSampler(range(n), from_idx=from_idx), **loader_kwargs)
     else:
         train_dataset, val_dataset, test_dataset = random_split(dataset, [n_train, n_val, n_test])
 
-        train_loader = data.DataLoader(train_dataset, batch_size=batch_size, shuffle=shuffle, collate_fn=my_collate)
-        val_loader = data.DataLoader(val_dataset, batch_size=batch_size, shuffle=shuffle, collate_fn=my_collate)
-        test_loader = data.DataLoader(test_dataset, batch_size=batch_size, shuffle=shuffle, collate_fn=my_collate)
+        train_loader = data.DataLoader(train_dataset, batch_size=batch_size, shuffle=shuffle, collate_fn=my_collate, **loader_kwargs)
+        val_loader = data.DataLoader(val_dataset, batch_size=batch_size, shuffle=shuffle, collate_fn=my_collate, **loader_kwargs)
+        test_loader = data.DataLoader(test_dataset, batch_size=batch_size, shuffle=shuffle, collate_fn=my_collate, **loader_kwargs)
 
     return train_loader, val_loader, test_loader, list(id2class.values()), id2class
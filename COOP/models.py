@@ -1,3 +1,4 @@
+import contextlib
 import torch
 import torch.nn as nn
 import open_clip
@@ -86,6 +87,22 @@ class PromptLearner(nn.Module):
         self.name_lens = name_lens
         self.class_token_position = class_token_position
 
+        # For the "middle" and "front" positions the prompt of each class is a fixed permutation of
+        # [prefix, ctx, suffix]: compute it once instead of slicing and concatenating class by class
+        if class_token_position in ("middle", "front"):
+            seq_len = tokenized_prompts.shape[1]
+            half_n_ctx = n_ctx // 2
+            token_order = []
+            for name_len in name_lens:
+                ctx_pos = list(range(1, 1 + n_ctx))
+                class_pos = list(range(1 + n_ctx, 1 + n_ctx + name_len))
+                rest_pos = list(range(1 + n_ctx + name_len, seq_len))
+                if class_token_position == "middle":
+                    token_order.append([0] + ctx_pos[:half_n_ctx] + class_pos + ctx_pos[half_n_ctx:] + rest_pos)
+                else:
+                    token_order.append([0] + class_pos + ctx_pos + rest_pos)
+            self.register_buffer("token_order", torch.tensor(token_order, device=tokenized_prompts.device), persistent=False)
+
     def forward(self):
         prefix = self.token_prefix
         suffix = self.token_suffix
@@ -95,60 +112,21 @@ class PromptLearner(nn.Module):
         if ctx.dim() == 2:
             ctx = ctx.unsqueeze(0).expand(self.n_cls, -1, -1)
         
-        if self.class_token_position == "end":
-            prompts = torch.cat(
-                [
-                    prefix,  # (n_cls, 1, dim)
-                    ctx,     # (n_cls, n_ctx, dim)
-                    suffix,  # (n_cls, *, dim)
-                ],
-                dim=1,
-            )
-
-        elif self.class_token_position == "middle":
-            half_n_ctx = self.n_ctx // 2
-            prompts = []
-            for i in range(self.n_cls):
-                name_len = self.name_lens[i]
-                prefix_i = prefix[i : i + 1, :, :]
-                class_i = suffix[i : i + 1, :name_len, :]
-                suffix_i = suffix[i : i + 1, name_len:, :]
-                ctx_i_half1 = ctx[i : i + 1, :half_n_ctx, :]
-                ctx_i_half2 = ctx[i : i + 1, half_n_ctx:, :]
-                prompt = torch.cat(
-                    [
-                        prefix_i,     # (1, 1, dim)
-                        ctx_i_half1,  # (1, n_ctx//2, dim)
-                        class_i,      # (1, name_len, dim)
-                        ctx_i_half2,  # (1, n_ctx//2, dim)
-                        suffix_i,     # (1, *, dim)
-                    ],
-                    dim=1,
-                )
-                prompts.append(prompt)
-            prompts = torch.cat(prompts, dim=0)
-
-        elif self.class_token_position == "front":
-            prompts = []
-            for i in range(self.n_cls):
-                name_len = self.name_lens[i]
-                prefix_i = prefix[i : i + 1, :, :]
-                class_i = suffix[i : i + 1, :name_len, :]
-                suffix_i = suffix[i : i + 1, name_len:, :]
-                ctx_i = ctx[i : i + 1, :, :]
-                prompt = torch.cat(
-                    [
-                        prefix_i,  # (1, 1, dim)
-                        class_i,   # (1, name_len, dim)
-                        ctx_i,     # (1, n_ctx, dim)
-                        suffix_i,  # (1, *, dim)
-                    ],
-                    dim=1,
-                )
-                prompts.append(prompt)
-            prompts = torch.cat(prompts, dim=0)
-
-        else:
+        prompts = torch.cat(
+            [
+                prefix,  # (n_cls, 1, dim)
+                ctx,     # (n_cls, n_ctx, dim)
+                suffix,  # (n_cls, *, dim)
+            ],
+            dim=1,
+        )
+
+        if self.class_token_position in ("middle", "front"):
+            # Move the class tokens to their position for all the classes with a single gather
+            token_order = self.token_order.unsqueeze(-1).expand(-1, -1, prompts.shape[-1])
+            prompts = prompts.gather(1, token_order)
+
+        elif self.class_token_position != "end":
             raise ValueError
 
         return prompts
@@ -171,18 +149,37 @@ class OurCLIP(nn.Module):
         self.text_encoder = TextEncoder(clip_model)
         self.logit_scale = clip_model.logit_scale
 
-    def forward(self, image):
-        image_features = self.image_encoder(image)
+    def encode_image_no_grad(self, image):
+        """
+        Returns the fp32 normalized image features. The image encoder is frozen, so no graph is built for it
+        """
+        with torch.no_grad():
+            image_features = self.image_encoder(image).float()
+        return image_features / image_features.norm(dim=-1, keepdim=True)
 
+    def encode_text_with_prompt(self):
+        """
+        Returns the normalized text features of the learned prompts, the only path carrying gradients
+        """
         prompts = self.prompt_learner()
-        tokenized_prompts = self.tokenized_prompts
-        text_features = self.text_encoder(prompts, tokenized_prompts)
-
-        image_features = image_features / image_features.norm(dim=-1, keepdim=True)
-        text_features = text_features / text_features.norm(dim=-1, keepdim=True)
-
-        logit_scale = self.logit_scale.exp()
-        logits = logit_scale * image_features @ text_features.t()
+        text_features = self.text_encoder(prompts, self.tokenized_prompts)
+        return text_features / text_features.norm(dim=-1, keepdim=True)
+
+    def forward(self, image=None, image_features=None):
+        """
+        Classifies either the images or their normalized features, as returned by encode_image_no_grad
+        """
+        if image_features is None:
+            image_features = self.encode_image_no_grad(image)
+        text_features = self.encode_text_with_prompt()
+
+        # The encoders may run under bf16 autocast, the similarities are computed in fp32:
+        # logits around 20-40 would be rounded by up to 0.25 in bf16, more than the gap between the top classes
+        no_autocast = torch.autocast("cuda", enabled=False) if image_features.is_cuda else contextlib.nullcontext()
+        with no_autocast:
+            image_features, text_features = image_features.float(), text_features.float()
+            logit_scale = self.logit_scale.exp()
+            logits = logit_scale * image_features @ text_features.t()
 
         return logits, text_features
     
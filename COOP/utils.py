@@ -4,6 +4,18 @@ def get_optimizer(params, lr):
     optimizer = torch.optim.AdamW(params, lr)
     return optimizer
 
+def reset_optimizer(optimizer):
+    """
+    Resets AdamW to its freshly created state in place: once the first step has allocated the moments
+    and the step counter, zeroing them is equivalent to an empty state and avoids reallocating them every batch
+    """
+    for state in optimizer.state.values():
+        for key, val in state.items():
+            if torch.is_tensor(val):
+                val.zero_()
+            elif key == "step":
+                state[key] = 0
+
 def get_loss_function():
     loss_function = torch.nn.CrossEntropyLoss()
     return loss_function
@@ -1,4 +1,6 @@
 import torch
+import warnings
+import torch.nn.functional as F
 import open_clip
 from torchvision.transforms import transforms
 from typing import List
@@ -10,10 +12,52 @@ class Captioner():
             pretrained=version, 
             cache_dir='./.dl-cache'
             )
-        self.caption_model.to(device)
+        # The captioner is never trained: keep it in eval mode, without autograd and in bf16 when supported
+        self.dtype = torch.bfloat16 if device == "cuda" and torch.cuda.is_bf16_supported() else torch.float32
+        self.caption_model = self.caption_model.to(device, dtype=self.dtype).eval()
+        for param in self.caption_model.parameters():
+            param.requires_grad_(False)
         self.tokenizer = open_clip.get_tokenizer(model_name)
         self.device = device
+
+        self.encode_text_scripted = self._trace_encode_text()
+        self._class_features = None
+        self._scale = None
     
+    def _trace_encode_text(self):
+        """
+        Traces the text encoder. The tokens are padded to the context length, but the batch size of the
+        captions (k views of M images) varies at runtime: the trace is made on a batch of 7 captions and compared
+        with the eager encode_text on a batch of 3, falling back to the eager encoder if they differ.
+
+        Returns:
+            Callable: The text encoder, [B, context_length] tokens -> [B, D] features.
+        """
+        trace_tokens = self.tokenizer([f"a photo of {i} things" for i in range(7)]).to(self.device)
+        check_tokens = self.tokenizer(["a photo of", "a bird on a branch", "a red car"]).to(self.device)
+        with torch.no_grad():
+            traced_model = torch.jit.trace_module(self.caption_model, {"encode_text": trace_tokens})
+            traced, eager = traced_model.encode_text(check_tokens), self.caption_model.encode_text(check_tokens)
+        if traced.shape != eager.shape or not torch.allclose(traced.float(), eager.float(), rtol=1e-2, atol=1e-2):
+            warnings.warn("The traced text encoder does not match encode_text for another batch size, using it eagerly")
+            return self.caption_model.encode_text
+        return traced_model.encode_text
+
+    def precompute_class_text(self, id2class: dict) -> None:
+        """
+        Encodes the "A photo of {cls}" prompts for every class once and stores the
+        normalized features and the logit scale, so that they are not recomputed for every batch.
+
+        Args:
+            id2class (dict): The mapping from class index to class name.
+        """
+        classes = list(id2class.values())
+        with torch.no_grad():
+            class_tokens = self.tokenizer([f"A photo of {cls}" for cls in classes])
+            class_features = self.caption_model.encode_text(class_tokens.to(self.device), normalize=False)
+            self._class_features = F.normalize(class_features)
+            self._scale = self.caption_model.logit_scale.exp()
+
     def _tokenize(self, x: str) -> torch.Tensor:
         """
         Tokenizes the input text using the tokenizer.
@@ -80,7 +124,7 @@ class Captioner():
         prompt_extended = self._tokenize(prompt).to(self.device)
             
         generated = self._generate_macro( 
-            images, 
+            images.to(self.dtype), 
             prompt_extended)
         
         assert len(generated) == len(images)
@@ -7,7 +7,7 @@ import py_vars
 import random
 import os
 
-from torchvision.transforms import v2
+from torchvision.transforms import v2, InterpolationMode
 from augmix import augmentations, post_augmentations, augmentations_basic
 from PIL import Image
 
@@ -75,18 +75,24 @@ def _augmix(image, preprocess, aug_list, severity=1):
     x_processed = preprocess(x_orig)
     if len(aug_list) == 0:
         return x_processed
-    w = np.float32(np.random.dirichlet([1.0, 1.0, 1.0]))
-    m = np.float32(np.random.beta(1.0, 1.0))
+    # Mixing weights from the torch RNG, as python floats for the in-place add_ below
+    w = torch.distributions.Dirichlet(torch.ones(3)).sample().tolist()
+    m = torch.distributions.Beta(1., 1.).sample().item()
 
+    # Op schedule of the 3 chains drawn at once: depth of every chain and index of every op
+    depths = torch.randint(1, 4, (3,)).tolist()
+    ops = torch.randint(len(aug_list), (3, 3)).tolist()
+
+    # The ops return new images, the chains can start from x_orig without copying it.
+    # The chains are accumulated in place in a single mix buffer
     mix = torch.zeros_like(x_processed)
     for i in range(3):
-        x_aug = x_orig.copy()
-        for _ in range(np.random.randint(1, 4)):
-            x_aug = np.random.choice(aug_list)(x_aug)
-            # x_aug = np.random.choice(aug_list)(x_aug, severity)
-        mix += w[i] * preprocess(x_aug)
-    mix = m * x_processed + (1 - m) * mix
-    return mix
+        x_aug = x_orig
+        for op in ops[i][:depths[i]]:
+            x_aug = aug_list[op](x_aug)
+            # x_aug = aug_list[op](x_aug, severity)
+        mix.add_(preprocess(x_aug), alpha=w[i])
+    return mix.mul_(1 - m).add_(x_processed, alpha=m)
 
 class Augmixer(object):
     def __init__(self, preprocess, n_views=64, augmix=False, 
@@ -116,6 +122,52 @@ class Augmixer(object):
         return img
     
 
+class GPUAugmixer(torch.nn.Module):
+    """
+    Generates the n_views TPT views of a batch of images on the device the images live on.
+    The DataLoader only decodes the images with `cpu_transform` into fixed size uint8 tensors, resized
+    without cropping so that the random crops cover the whole image as in Augmixer (the aspect ratio is not kept).
+    Crops, flips, AugMix and normalization are then applied by `forward` as tensor ops.
+    """
+    def __init__(self, n_views=64, severity=1, size=224, load_size=256):
+        super().__init__()
+        self.n_views = n_views-1
+        clip_mean = (0.48145466, 0.4578275, 0.40821073)
+        clip_std = (0.26862954, 0.26130258, 0.27577711)
+
+        self.cpu_transform = v2.Compose([
+            v2.PILToTensor(),
+            v2.Resize((load_size, load_size), interpolation=InterpolationMode.BICUBIC, antialias=True),
+        ])
+        self.preprocess = v2.Compose([
+            v2.Resize(size, interpolation=InterpolationMode.BICUBIC, antialias=True),
+            v2.ToDtype(torch.float32, scale=True),
+            v2.Normalize(mean=clip_mean, std=clip_std),
+        ])
+        self.augment = v2.Compose([
+            v2.RandomResizedCrop(size, interpolation=InterpolationMode.BICUBIC, antialias=True),
+            v2.RandomHorizontalFlip(),
+            v2.AugMix(severity=severity),
+            v2.ToDtype(torch.float32, scale=True),
+            v2.Normalize(mean=clip_mean, std=clip_std),
+        ])
+
+    @torch.no_grad()
+    def forward(self, images):
+        """
+        :param images: torch.Tensor: uint8 images [C, H, W] or [M, C, H, W]
+        :return: torch.Tensor: normalized views [M, n_views, C, size, size], the first view is the original image
+        """
+        if images.dim() == 3:
+            images = images.unsqueeze(0)
+        # v2 transforms sample their random parameters once per call for the whole batch,
+        # hence one call per view of every image so that each view gets its own crop, flip and AugMix
+        augmented = torch.stack([
+            torch.stack([self.augment(image) for _ in range(self.n_views)]) for image in images
+        ])
+        return torch.cat([self.preprocess(images).unsqueeze(1), augmented], dim=1)
+
+
 def load_pretrained_coop(backbone, _model, device="cuda"):
     """
     Loads coop pretrained context
@@ -10,6 +10,7 @@ import torchvision.transforms as transforms
 import torch.nn.functional as F
 import logging
 import pickle
+import contextlib
 import matplotlib.pyplot as plt
 try:
     from torchvision.transforms import InterpolationMode
@@ -19,57 +20,83 @@ except ImportError:
 
 from CLIP import clip
 
-from COOP.utils import get_optimizer, log_values, get_loss_function
+from COOP.utils import get_optimizer, log_values, get_loss_function, reset_optimizer
 from COOP.functions import training_step, test_step
 from COOP.dataloader import get_data
 from COOP.models import OurCLIP
 from coca_model import Captioner
-from loaders import Augmixer, load_pretrained_coop
+from loaders import Augmixer, GPUAugmixer, load_pretrained_coop
 from tqdm import tqdm
-from utils import (entropy, avg_entropy, batch_report, filter_on_entropy, AverageMeter,
-                report_predictions, make_histogram, compute_accuracies, caption_report, create_run_info)
+from utils import (entropy, avg_entropy, batch_report, filter_on_entropy, AverageMeter, ClassAccuracyMeter,
+                report_predictions, make_histogram, compute_accuracies, caption_report, create_run_info, run_io)
 from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
 
 
 DEBUG = False
 RUN_NAME = "imagenetV2/entropy-avg--CoCa-p1"
 LOG_FREQUENCY = 100
 ENSAMBLE_METHOD = 'entropy'
+ICE_SKIP_ENTROPY = None # fraction of log(K), below it the captioner is skipped
 logger = logging.getLogger(__name__)
 
 
 def get_caption_logits(captioner:Captioner, captions, id2class):
-    from open_clip import factory
-    device = DEVICE
-    classes = list(id2class.values())
-    tokenizer = factory.get_tokenizer("coca_ViT-L-14")
-    with torch.cuda.amp.autocast(), torch.no_grad():
-        class_tokens = tokenizer([f"A photo of {cls}" for cls in classes])
-        class_features = captioner.caption_model.encode_text(class_tokens.to(device), normalize=False)
+    # Class prompts are constant across the test loop: encode them only once
+    if captioner._class_features is None:
+        captioner.precompute_class_text(id2class)
 
-        caption_tokens = tokenizer(captions)
-        caption_features = captioner.caption_model.encode_text(caption_tokens.to(device))
+    with torch.no_grad():
+        caption_tokens = captioner.tokenizer(captions)
+        caption_features = captioner.encode_text_scripted(caption_tokens.to(captioner.device))
 
-        scale = captioner.caption_model.logit_scale.exp()
-        caption_logits = F.normalize(caption_features) @ F.normalize(class_features).T
+        caption_logits = F.normalize(caption_features) @ captioner._class_features.T
 
 
-    return (caption_logits * scale).softmax(-1)
+    # Upcast before scaling, bf16 logits scaled by ~100 would be rounded to 0.5
+    return (caption_logits.float() * captioner._scale.float()).softmax(-1)
 
-def add_caption_loss(net: OurCLIP, captioner: Captioner, batch, text_features, id2classes, prompt="a ", ensamble_method="entropy", K=200, debug=False):
+def _combine_logits(image_logits, caption_logits, ensamble_method="entropy"):
+    """
+    Ensembles the [..., K] image and caption probabilities into the ICE scores.
+    Pure tensor function, main() passes down a compiled version of it when running on CUDA.
+    """
+    if ensamble_method == "std_dev":
+        # Lambda computed as a normalization term: caption std over the L2 norm of (image std, caption std)
+        std_image, std_caption = image_logits.std(dim=-1), caption_logits.std(dim=-1)
+        coef = 0.08 * std_caption / torch.hypot(std_image, std_caption).clamp_min(1e-12)
+        # Sum the image and caption scores to obtain the ICE scores
+        return image_logits + coef[..., None] * caption_logits
+    elif ensamble_method == "entropy":
+        # Per-sample confidence weights, computed for the whole batch at once
+        A = 1/(1 + entropy(image_logits))
+        B = 1/(1 + entropy(caption_logits))
+        C = A + B
+        return (A/C)[..., None] * image_logits + (B/C)[..., None] * caption_logits
+    elif ensamble_method == "harmonic_mean":
+        return (2 * image_logits * caption_logits) / (image_logits + caption_logits).clamp_min(1e-12)
+    else:
+        raise ValueError("Ensamble method not implemented")
+
+def add_caption_loss(net: OurCLIP, captioner: Captioner, batch, text_features, id2classes, prompt="a ", ensamble_method="entropy", K=200, debug=False, skip_entropy=None, combine_logits=_combine_logits, io_pool=None):
     """
     Adds caption loss to the filtered_outputs using the given captioner.
 
     Args:
         net (OurCLIP): The network used to generate the text features.
         captioner (Captioner): The captioner object used to generate captions.
-        batch (tuple): Tuple containing filtered inputs and outputs, batch_idx and label
+        batch (tuple): Tuple containing batch_idx, filtered inputs [M, k, C, H, W] and outputs [M, k, K]
+            (or [k, C, H, W] and [k, K] for a single image) and the labels [M]
         text_features: The text features of the labels computed by the model.
         id2classes (dict): The mapping from class index to class name.
         prompt (str): The prompt used for generating captions. Default is "a ".
         _lambda (float): The value of lambda used for computing the weighted logit summation
         K (int): The number of top classes to consider. Default is 200.
         debug (bool): Whether to print debug information. Default is False.
+        skip_entropy (float): If given, the filtered_outputs of an image are left unchanged when their mean
+            entropy is below skip_entropy * log(n_classes), without generating its captions. Default is None.
+        combine_logits (callable): The ensembling function, _combine_logits or its compiled version.
+        io_pool (ThreadPoolExecutor): The background I/O worker rendering the caption reports. Default is None.
 
     Returns:
     
@@ -77,10 +104,25 @@ def add_caption_loss(net: OurCLIP, captioner: Captioner, batch, text_features, i
         The caption prediction from the average of all the logits
     """
     batch_idx, filtered_inputs, filtered_outputs, label = batch
-    # Compute captions for each augmentation using coca functions
-    device = filtered_inputs.device
-    with torch.no_grad(), torch.cuda.amp.autocast():
-        captions = captioner.generate_captions(filtered_inputs, prompt)
+    single_image = filtered_outputs.dim() == 2
+    if single_image:
+        filtered_inputs, filtered_outputs = filtered_inputs.unsqueeze(0), filtered_outputs.unsqueeze(0)
+    n_views = filtered_outputs.shape[1]
+
+    # Only the images whose prediction is not already confident are captioned
+    to_caption = torch.ones(filtered_outputs.shape[0], dtype=torch.bool, device=filtered_outputs.device)
+    if skip_entropy is not None:
+        mean_entropy = entropy(filtered_outputs).mean(dim=1)
+        to_caption = mean_entropy >= skip_entropy * np.log(filtered_outputs.shape[-1])
+        if not to_caption.any():
+            return filtered_outputs[0] if single_image else filtered_outputs
+    caption_all = bool(to_caption.all())
+    caption_inputs = filtered_inputs if caption_all else filtered_inputs[to_caption]
+    image_logits = filtered_outputs if caption_all else filtered_outputs[to_caption]
+
+    # Compute captions for the views of all the images with a single coca call
+    with torch.no_grad():
+        captions = captioner.generate_captions(caption_inputs.flatten(0, 1), prompt)
     
     # Encode all the captions using the clip encoder (batchfying the captions to save compute)
     # caption_tokens = clip.tokenize(captions).to(device)
@@ -89,187 +131,218 @@ def add_caption_loss(net: OurCLIP, captioner: Captioner, batch, text_features, i
     
     # caption_logits = net.logit_scale.exp()*(F.normalize(caption_features) @ text_features.T)
     # caption_logits = caption_logits.softmax(-1)
-    caption_logits = get_caption_logits(captioner, captions, id2classes)
-    image_logits = filtered_outputs
+    caption_logits = get_caption_logits(captioner, captions, id2classes).view(image_logits.shape)
 
     # Compute the value of lambda following ice implementation row 193 main_ice.py
     assert K == 200, "For k != 200, function has to be implemented"
 
-    # Lambda computed as a normalization term
-    ice_scores = torch.zeros_like(image_logits)
+    ice_scores = combine_logits(image_logits, caption_logits, ensamble_method)
 
-    if ensamble_method == "std_dev":
-        std_devs = torch.stack((image_logits.std(dim=1), caption_logits.std(dim=1)), dim=1)
-        coef = 0.08 * F.normalize(std_devs, dim=1)
-        coef = coef[:, 1].unsqueeze(1).expand(-1, K)
-        # Sum the image and caption scores to obtain the ICE scores
-        ice_scores = image_logits + coef * caption_logits
-    elif ensamble_method == "entropy":
-        for batch in range(image_logits.shape[0]):
-            A = 1/(1 + entropy(image_logits[batch]).item())
-            B = 1/(1 + entropy(caption_logits[batch]).item())
-            C = A + B
-            ice_scores[batch] = (A/C * image_logits[batch] + B/C * caption_logits[batch])
-    elif ensamble_method == "harmonic_mean":
-        for batch in range(image_logits.shape[0]):
-            ice_scores[batch] = (2 * image_logits[batch] * caption_logits[batch]).div(image_logits[batch] + caption_logits[batch])
-    else:
-        raise ValueError("Ensamble method not implemented")
+    if debug or batch_idx % LOG_FREQUENCY == 0:
+        # Report the first captioned image only
+        caption_label = label if caption_all else label[to_caption]
+        caption_prediction = torch.mean(caption_logits[0], dim=0)
+        caption_report(caption_inputs[0], image_logits[0], caption_logits[0], ice_scores[0], caption_label[0:1],
+                       captions[:n_views], caption_prediction, id2classes, batch_idx, io_pool=io_pool)
 
-    caption_prediction = torch.mean(caption_logits, dim=0)
-    if debug:
-        caption_report(filtered_inputs, image_logits, caption_logits, ice_scores, label, captions, caption_prediction, id2classes, batch_idx)    
+    if not caption_all:
+        ice_scores = filtered_outputs.index_put((to_caption,), ice_scores)
+    return ice_scores[0] if single_image else ice_scores
 
-    if batch_idx % LOG_FREQUENCY == 0:
-        caption_report(filtered_inputs, image_logits, caption_logits, ice_scores, label, captions, caption_prediction, id2classes, batch_idx)    
-    return ice_scores
 
+def _autocast(device_type, amp_dtype):
+    """
+    Mixed precision context for amp_dtype, a no-op when it is None. Only used on CUDA: torch.autocast raises
+    on older torch versions for devices without autocast support (mps) even when disabled
+    """
+    if amp_dtype is None or device_type != "cuda":
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device_type, dtype=amp_dtype)
 
-def tta_net_train(batch, net, optimizer, scaler, id2classes, device="cuda", captioner=None, debug=False):
+def tta_net_train(batch, net, optimizer, scaler, id2classes, device="cuda", captioner=None, debug=False, amp_dtype=None, combine_logits=_combine_logits, io_pool=None):
     batch_idx, inputs, targets = batch
 
-    inputs = inputs.to(device)
-    targets = targets.to(device)
-
-    # Forward pass
-    outputs, text_features = net(inputs)
-    outputs = outputs.softmax(dim=-1)
-
-    filtered_inputs, filtered_outputs = filter_on_entropy(inputs, outputs, p_percentile=10, return_original=debug)
-    if captioner is not None:
-        batch = (batch_idx, filtered_inputs, filtered_outputs, targets)
-        filtered_outputs = add_caption_loss(net, captioner, batch, text_features, id2classes, debug=debug, ensamble_method=ENSAMBLE_METHOD)
-
-    avg_predictions = torch.mean(filtered_outputs, dim=0).unsqueeze(0)
-    prediction_entropy = entropy(avg_predictions).item()
+    inputs = inputs.to(device, non_blocking=True)
+    targets = targets.to(device, non_blocking=True)
+    if inputs.dim() == 4:
+        # Single test image [N, C, H, W] -> [1, N, C, H, W]
+        inputs = inputs.unsqueeze(0)
+    n_images, n_views = inputs.shape[:2]
+
+    # Forward pass of all the views of all the images at once
+    flat_inputs = inputs.flatten(0, 1)
+    if flat_inputs.is_cuda:
+        flat_inputs = flat_inputs.contiguous(memory_format=torch.channels_last)
+    with _autocast(flat_inputs.device.type, amp_dtype):
+        image_features = net.encode_image_no_grad(flat_inputs)
+        logits, text_features = net(image_features=image_features)
+        logits = logits.view(n_images, n_views, -1)
+
+        # Select the views on the logits, probabilities are only needed for the selected ones
+        filtered_inputs, filtered_logits = filter_on_entropy(inputs, logits, p_percentile=10, return_original=debug, from_logits=True)
+        filtered_outputs = filtered_logits.softmax(dim=-1)
+        if captioner is not None:
+            filtered_outputs = add_caption_loss(net, captioner, (batch_idx, filtered_inputs, filtered_outputs, targets),
+                                                text_features, id2classes, debug=debug, ensamble_method=ENSAMBLE_METHOD,
+                                                skip_entropy=ICE_SKIP_ENTROPY, combine_logits=combine_logits, io_pool=io_pool)
+
+        avg_predictions = torch.mean(filtered_outputs, dim=1) # [M, K]
+        prediction_entropy = entropy(avg_predictions).mean().detach()
+
+        # The prompt learner is shared, a single step adapts it to all the images of the batch
+        loss = avg_entropy(filtered_outputs).mean()
 
     optimizer.zero_grad()
-    loss = avg_entropy(filtered_outputs)
-
-    if scaler is None:        
+    if scaler is None:
+        # fp32 or bf16 autocast, no loss scaling needed
         loss.backward()
         optimizer.step()
     else:
-        with torch.cuda.amp.autocast():
-            scaler.scale(loss).backward()
-            scaler.step(optimizer)
-            scaler.update()
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
     # show batch
     if debug:
-        batch_report(filtered_inputs, filtered_outputs, avg_predictions, targets, id2classes, batch_n=batch_idx)
+        batch_report(filtered_inputs[0], filtered_outputs[0], avg_predictions[0:1], targets[0:1], id2classes, batch_n=batch_idx, io_pool=io_pool)
     if batch_idx % LOG_FREQUENCY == 0:
-        batch_report(filtered_inputs, filtered_outputs, avg_predictions, targets, id2classes, batch_n=batch_idx)
+        batch_report(filtered_inputs[0], filtered_outputs[0], avg_predictions[0:1], targets[0:1], id2classes, batch_n=batch_idx, io_pool=io_pool)
         
     prediction = avg_predictions.argmax(dim=1)
-    return loss.item(), prediction, prediction_entropy
+    # Features of the original views, the image encoder is frozen so they are reused by the evaluation after
+    # the update, which then classifies the same fp32 features as the no-TPT prediction
+    original_features = image_features.view(n_images, n_views, -1)[:, 0]
+    return loss.detach(), prediction, prediction_entropy, original_features
+
+def _dump_checkpoint(dump_object, path):
+    with open(path, "wb") as file:
+        pickle.dump(dump_object, file)
+
+def _log_histogram(writer, no_tpt_accuracies, accuracies, batch_idx):
+    histogram = make_histogram(no_tpt_accuracies, accuracies, 
+                            'No TPT', 'TPT', save_path=f"runs/{RUN_NAME}/class_accuracy%{batch_idx}e.png")
+    writer.add_image(f"Class accuracies%{batch_idx}e", histogram, batch_idx, dataformats="HWC")
+
+def _log_final_histograms(writer, no_tpt_accuracies, accuracies):
+    make_histogram(no_tpt_accuracies, accuracies, 'No TPT','TPT', save_path=f"runs/{RUN_NAME}/accuracy_by_class.png")
+    image = make_histogram(no_tpt_accuracies, accuracies, 'No TPT','TPT', save_path=f"runs/{RUN_NAME}/accuracy_by_worst_class.png", worst_case=True)
+    writer.add_image("Class accuracies", image, 0, dataformats="HWC")
 
-def tpt_train_loop(data_loader, net, optimizer, cost_function, scaler, writer, id2classes, device="cuda", captioner=None, debug=False, checkpoint=None):
+def _flush_results(pending, writer, cumulative_loss, top1, top5, no_tpt_class_acc, tpt_class_acc):
+    """
+    Copies the per-batch results buffered on the device since the last flush to the CPU at once,
+    then updates the meters and logs the per-batch scalars.
+    Returns the last delta loss, delta entropy and test loss
+    """
+    stats = torch.stack([batch_stats for _, batch_stats, _, _, _ in pending]).cpu().tolist()
+    targets = torch.cat([batch_targets for _, _, batch_targets, _, _ in pending]).cpu()
+    no_tpt_class_acc.update(targets, torch.cat([no_tpt_hits for _, _, _, no_tpt_hits, _ in pending]))
+    tpt_class_acc.update(targets, torch.cat([hits for _, _, _, _, hits in pending]))
+
+    for (batch_idx, _, batch_targets, _, _), batch_stats in zip(pending, stats):
+        tpt_loss, loss, prediction_entropy, no_tpt_prediction_entropy, n_hits, n_top5_hits = batch_stats
+        n = batch_targets.shape[0]
+        cumulative_loss.update_scalar(loss, n=n)
+        top1.update_scalar(n_hits / n, n=n)
+        top5.update_scalar(n_top5_hits / n, n=n)
+
+        loss_diff =  tpt_loss - loss # comparison of loss with and without TPT
+        entropy_diff = prediction_entropy - no_tpt_prediction_entropy # comparison of entropy with and without TPT
+        # Log Values
+        writer.add_scalar("Delta_loss/test", loss_diff, batch_idx)
+        writer.add_scalar("Delta_entropy/test", entropy_diff, batch_idx)
+        writer.add_scalar("Top-1", top1.get_avg(), batch_idx)
+        writer.add_scalar("Top-5", top5.get_avg(), batch_idx)
+
+    pending.clear()
+    return loss_diff, entropy_diff, loss
+
+def tpt_train_loop(data_loader, net, optimizer, cost_function, scaler, writer, id2classes, device="cuda", captioner=None, debug=False, checkpoint=None, amp_dtype=None, io_pool=None, augmenter=None, combine_logits=_combine_logits):
     
     if checkpoint:
-        offset, cumulative_loss, top1, top5, no_tpt_class_acc, tpt_class_acc = checkpoint
+        offset, cumulative_loss, top1, top5, no_tpt_class_acc, tpt_class_acc = checkpoint[:6]
+        if isinstance(no_tpt_class_acc, dict):
+            no_tpt_class_acc = ClassAccuracyMeter.from_meters(id2classes, no_tpt_class_acc)
+            tpt_class_acc = ClassAccuracyMeter.from_meters(id2classes, tpt_class_acc)
     else:
         offset = 0
         cumulative_loss = AverageMeter()
         top1 = AverageMeter()
         top5 = AverageMeter()
 
-        no_tpt_class_acc = {c: AverageMeter() for c in id2classes.values()}
-        tpt_class_acc = {c: AverageMeter() for c in id2classes.values()}
+        no_tpt_class_acc = ClassAccuracyMeter(id2classes)
+        tpt_class_acc = ClassAccuracyMeter(id2classes)
     
-    loss_diff = 0.0
-    optimizer_state = deepcopy(optimizer.state_dict())
+    loss_diff, entropy_diff = 0.0, 0.0
+    pending = [] # per-batch results not yet copied to the CPU
 
     try:
         pbar = tqdm(data_loader, desc="Testing", position=0, leave=True, initial=offset, total=len(data_loader)+offset)
         for batch_idx, (inputs, targets, _) in enumerate(data_loader):
             batch_idx += offset # offset to continue from a checkpoint
+            if augmenter is not None:
+                # The loader only decoded the images, the views are generated on the device
+                inputs = augmenter(inputs.to(device, non_blocking=True))
 
             # Reset the prompt_learner to its initial state and the optimizer to its initial state
             with torch.no_grad():
                 net.reset()
-                optimizer.load_state_dict(optimizer_state)
+                reset_optimizer(optimizer)
 
-            _loss, no_tpt_prediction, no_tpt_prediction_entropy = tta_net_train((batch_idx, inputs, targets), net, optimizer, scaler, id2classes, device=device, captioner=captioner, debug=debug)
+            _loss, no_tpt_prediction, no_tpt_prediction_entropy, image_features = tta_net_train((batch_idx, inputs, targets), net, optimizer, scaler, id2classes, device=device, captioner=captioner, debug=debug, amp_dtype=amp_dtype, combine_logits=combine_logits, io_pool=io_pool)
 
             net.eval()
             with torch.no_grad():
-                # Classification with the updated net
-                inputs = inputs[0].unsqueeze(0).to(device)
-                targets = targets.to(device)
-                outputs, _ = net(inputs)
+                # Classification of the original views with the updated prompts, only the text tower is run again
+                targets = targets.to(device, non_blocking=True)
+                outputs, _ = net(image_features=image_features)
                 loss = cost_function(outputs, targets)
                 prediction = outputs.argmax(dim=1)
-                prediction_entropy = entropy(prediction).item()
-
-                cumulative_loss.update(loss.item())
-
-            # Update accuracies
-            _key = id2classes[targets.item()]
-            if no_tpt_prediction.item() == targets.item():
-                no_tpt_class_acc[_key].update(1)
-            else:
-                no_tpt_class_acc[_key].update(0)
+                prediction_entropy = entropy(outputs.softmax(dim=1)).mean()
 
+            # Keep the results on the device, they are copied to the CPU once every LOG_FREQUENCY batches
             values, predictions = outputs.topk(5)
-            if prediction == targets:
-                top1.update(1)
-                tpt_class_acc[_key].update(1)
-            else:
-                top1.update(0)
-                tpt_class_acc[_key].update(0)
-
-            if targets.item() in predictions:
-                top5.update(1)
-            else:
-                top5.update(0)
+            no_tpt_hits = no_tpt_prediction == targets
+            hits = prediction == targets
+            top5_hits = (predictions == targets.unsqueeze(1)).any(dim=1)
+            batch_stats = torch.stack([stat.float() for stat in (_loss, loss, prediction_entropy, no_tpt_prediction_entropy, hits.sum(), top5_hits.sum())])
+            pending.append((batch_idx, batch_stats, targets, no_tpt_hits, hits))
 
             if debug:
                 top5_str = [id2classes[pred] for pred in predictions[0].tolist()]
-                target_str = id2classes[targets.item()]
+                target_str = id2classes[targets[0].item()]
                 report_predictions(batch_idx, top5_str, values, target_str)
 
-            loss_diff =  _loss - loss.item() # comparison of loss with and without TPT
-            entropy_diff = prediction_entropy - no_tpt_prediction_entropy # comparison of entropy with and without TPT
-            # Log Values
-            writer.add_scalar("Delta_loss/test", loss_diff, batch_idx)
-            writer.add_scalar("Delta_entropy/test", entropy_diff, batch_idx)
-            writer.add_scalar("Top-1", top1.get_avg(), batch_idx)
-            writer.add_scalar("Top-5", top5.get_avg(), batch_idx)
-
             if batch_idx % LOG_FREQUENCY == 0 :#and batch_idx > 10:
+                loss_diff, entropy_diff, test_loss = _flush_results(pending, writer, cumulative_loss, top1, top5, no_tpt_class_acc, tpt_class_acc)
                 logger.info(f"[LOSS] Batch {batch_idx} - Delta loss: {loss_diff:.5f}, Delta entropy: {entropy_diff:.5f}")
                 no_tpt_accuracies, accuracies = compute_accuracies(no_tpt_class_acc, tpt_class_acc)
-                histogram = make_histogram(no_tpt_accuracies, accuracies, 
-                                        'No TPT', 'TPT', save_path=f"runs/{RUN_NAME}/class_accuracy%{batch_idx}e.png")
-                writer.add_image(f"Class accuracies%{batch_idx}e", histogram, batch_idx, dataformats="HWC")
+                run_io(io_pool, _log_histogram, writer, no_tpt_accuracies, accuracies, batch_idx)
                 logger.info(f"[ACC] Batch num:{batch_idx} - Top1: {top1.get_avg()}, Top5: {top5.get_avg()}")
 
-                dump_object = batch_idx, cumulative_loss, top1, top5, no_tpt_class_acc, tpt_class_acc
-                pickle.dump(dump_object, open(f"runs/{RUN_NAME}/checkpoint%{batch_idx}.pkl", "wb"))
-            
-            
-            pbar.set_postfix(test_loss=loss.item(), top1=top1.get_avg(), top5=top5.get_avg())
+                # Snapshot the meters, they keep being updated while the checkpoint is written
+                # The number of images already evaluated is stored, the resumed run may use another --tpt_batch_size
+                dump_object = deepcopy((batch_idx, cumulative_loss, top1, top5, no_tpt_class_acc, tpt_class_acc, int(tpt_class_acc.total.sum())))
+                run_io(io_pool, _dump_checkpoint, dump_object, f"runs/{RUN_NAME}/checkpoint%{batch_idx}.pkl")
+
+                pbar.set_postfix(test_loss=test_loss, top1=top1.get_avg(), top5=top5.get_avg())
             pbar.update(1)
 
     except KeyboardInterrupt:
         print("User keyboard interrupt")
+    if pending:
+        loss_diff, entropy_diff, _ = _flush_results(pending, writer, cumulative_loss, top1, top5, no_tpt_class_acc, tpt_class_acc)
     if batch_idx % LOG_FREQUENCY != 0 or batch_idx == len(data_loader) + offset:#and batch_idx > 10:
         logger.info(f"[LOSS] Batch {batch_idx} - Delta loss: {loss_diff:.5f}, Delta entropy: {entropy_diff:.5f}")
         no_tpt_accuracies, accuracies = compute_accuracies(no_tpt_class_acc, tpt_class_acc)
-        histogram = make_histogram(no_tpt_accuracies, accuracies, 
-                                'No TPT', 'TPT', save_path=f"runs/{RUN_NAME}/class_accuracy%{batch_idx}e.png")
-        writer.add_image(f"Class accuracies%{batch_idx}e", histogram, batch_idx, dataformats="HWC")
+        run_io(io_pool, _log_histogram, writer, no_tpt_accuracies, accuracies, batch_idx)
         logger.info(f"[ACC] Batch num:{batch_idx} - Top1: {top1.get_avg()}, Top5: {top5.get_avg()}")
 
-        dump_object = batch_idx, cumulative_loss, top1, top5, no_tpt_class_acc, tpt_class_acc
-        pickle.dump(dump_object, open(f"runs/{RUN_NAME}/checkpoint%{batch_idx}.pkl", "wb"))
+        dump_object = batch_idx, cumulative_loss, top1, top5, no_tpt_class_acc, tpt_class_acc, int(tpt_class_acc.total.sum())
+        run_io(io_pool, _dump_checkpoint, dump_object, f"runs/{RUN_NAME}/checkpoint%{batch_idx}.pkl")
 
     # Draw histogram of class accuracies
     no_tpt_accuracies, accuracies = compute_accuracies(no_tpt_class_acc, tpt_class_acc)
-    image = make_histogram(no_tpt_accuracies, accuracies, 'No TPT','TPT', save_path=f"runs/{RUN_NAME}/accuracy_by_class.png")
-    image = make_histogram(no_tpt_accuracies, accuracies, 'No TPT','TPT', save_path=f"runs/{RUN_NAME}/accuracy_by_worst_class.png", worst_case=True)
-    
-    writer.add_image("Class accuracies", image, 0, dataformats="HWC")
+    run_io(io_pool, _log_final_histograms, writer, no_tpt_accuracies, accuracies)
 
     return cumulative_loss.get_avg() , top1.get_avg()
 
@@ -285,7 +358,9 @@ def main(
     class_token_position="end",
     csc=False,
     ice_loss=True,
-    debug=DEBUG
+    debug=DEBUG,
+    tpt_batch_size=1,
+    gpu_augment=False
 ):
 
     checkpoints = [file for file in os.listdir(f"runs/{RUN_NAME}") if file.startswith("checkpoint")]
@@ -294,7 +369,8 @@ def main(
                         key=lambda x: int(x.split("%")[1].split(".")[0]),
                         reverse=True)
         checkpoint = pickle.load(open(f"runs/{RUN_NAME}/{files[0]}", "rb"))
-        from_idx = checkpoint[0]
+        # Checkpoints store the number of images evaluated, older ones only the index of a batch of one image
+        from_idx = checkpoint[6] if len(checkpoint) > 6 else checkpoint[0]
     else:
         checkpoint = None
         from_idx = 0
@@ -304,14 +380,21 @@ def main(
     torch.manual_seed(seed)
     # Create a logger for the experiment
     run_name = RUN_NAME
-    writer = SummaryWriter(log_dir=f"runs/{run_name}")
+    # Scalars are logged every batch: queue them and flush once a minute
+    writer = SummaryWriter(log_dir=f"runs/{run_name}", flush_secs=60, max_queue=1000)
 
     _, preprocess = clip.load(backbone, device=device)
     
-    data_transform = Augmixer(preprocess, batch_size, augmix=True, severity=1)
+    augmenter = None
+    if gpu_augment:
+        augmenter = GPUAugmixer(batch_size, severity=1)
+        data_transform = augmenter.cpu_transform
+    else:
+        data_transform = Augmixer(preprocess, batch_size, augmix=True, severity=1)
     # Get dataloaders
     _, _, test_loader, classnames, id2class = get_data(
-        dataset_name, 1, data_transform, train_size=0, val_size=0, from_idx=from_idx
+        dataset_name, tpt_batch_size, data_transform, train_size=0, val_size=0, from_idx=from_idx,
+        num_workers=4, pin_memory=(device == 'cuda')
     )    
 
     # Instantiate the network and move it to the chosen device (GPU)
@@ -325,12 +408,21 @@ def main(
     ).to(device)
 
     load_pretrained_coop(backbone, net, device)
+    if device == 'cuda':
+        net = net.to(memory_format=torch.channels_last)
 
     print("Turning off gradients in both the image and the text encoder")
     for name, param in net.named_parameters():
         if "prompt_learner" not in name:
             param.requires_grad_(False)
 
+    combine_logits = _combine_logits
+    if device == 'cuda':
+        # Shapes are static across the test loop, so the compiled graphs are reused after warmup
+        net.image_encoder = torch.compile(net.image_encoder)
+        net = torch.compile(net, mode="reduce-overhead")
+        combine_logits = torch.compile(_combine_logits)
+
     print(f"Total parameters: {sum(p.numel() for p in net.parameters()):,}")
     print(
         f"Total trainable parameters: {sum(p.numel() for p in net.parameters() if p.requires_grad):,}"
@@ -341,10 +433,14 @@ def main(
 
     cost_function = get_loss_function()
 
+    # bf16 has the range of fp32, the GradScaler is only needed for the fp16 fallback
+    scaler, amp_dtype = None, None
     if device == 'cuda':
-        scaler = torch.cuda.amp.GradScaler(init_scale=1000)
-    else:
-        scaler = None
+        if torch.cuda.is_bf16_supported():
+            amp_dtype = torch.bfloat16
+        else:
+            amp_dtype = torch.float16
+            scaler = torch.cuda.amp.GradScaler(init_scale=1000)
 
     # Instantiate the captioner if needed
     captioner = None
@@ -352,9 +448,12 @@ def main(
         model_name = "coca_ViT-L-14"
         version = "laion2B-s13B-b90k"
         captioner = Captioner(model_name=model_name, version=version, device=device)
+        captioner.precompute_class_text(id2class)
 
     print(f"Beginning testing with TPT + ice_loss={ice_loss}:")
-    test_loss, test_accuracy = tpt_train_loop(test_loader, net, optimizer, cost_function, scaler, writer, id2classes=id2class, device=device, captioner=captioner, debug=debug, checkpoint=checkpoint)
+    io_pool = ThreadPoolExecutor(max_workers=1)
+    test_loss, test_accuracy = tpt_train_loop(test_loader, net, optimizer, cost_function, scaler, writer, id2classes=id2class, device=device, captioner=captioner, debug=debug, checkpoint=checkpoint, amp_dtype=amp_dtype, io_pool=io_pool, augmenter=augmenter, combine_logits=combine_logits)
+    io_pool.shutdown(wait=True)
     print(f"\tTest loss {test_loss:.5f}, Test accuracy {test_accuracy:.2f}")
     
     create_run_info(dataset_name, backbone, ice_loss, test_accuracy, run_name, ENSAMBLE_METHOD)
@@ -372,13 +471,17 @@ if __name__ == "__main__":
     parser.add_argument("--run_name", type=str, default="no-name")
     parser.add_argument("--ice_loss", action="store_true")
     parser.add_argument("--ensamble_method", type=str, default="entropy", choices=["entropy", "std_dev", "harmonic_mean"])
+    parser.add_argument("--ice_skip_entropy", type=float, default=None, help="Skip the captioner when the mean view entropy is below this fraction of log(n_classes), e.g. 0.3")
     parser.add_argument("--debug", action="store_true")
     parser.add_argument("--backbone", type=str, default="ViT-B/16")
     parser.add_argument("--dataset", type=str, default="imagenet_v2", choices=["imagenet_v2", "imagenet_a"])
+    parser.add_argument("--gpu_augment", action="store_true", help="Generate the augmented views on the device instead of in the DataLoader, with independent random parameters for every view of every image")
+    parser.add_argument("--tpt_batch_size", type=int, default=1, help="Number of test images adapted together in a single TPT step")
 
     args = parser.parse_args()
     RUN_NAME = args.run_name
     ENSAMBLE_METHOD = args.ensamble_method
+    ICE_SKIP_ENTROPY = args.ice_skip_entropy
     DEBUG = args.debug
 
 
@@ -407,4 +510,4 @@ if __name__ == "__main__":
     logger.addHandler(file_handler)
     logger.addHandler(stderr_handler)
 
-    main(dataset_name=args.dataset, backbone=args.backbone, device=DEVICE, ice_loss=args.ice_loss)
+    main(dataset_name=args.dataset, backbone=args.backbone, device=DEVICE, ice_loss=args.ice_loss, tpt_batch_size=args.tpt_batch_size, gpu_augment=args.gpu_augment)
@@ -1,17 +1,21 @@
 import torch
 import os
-import io
-import random
 import numpy as np
 import regex as re
 import json
+import math
+import logging
+import threading
 
 from datetime import datetime
 from torchvision import transforms
 from matplotlib import pyplot as plt
-from PIL import Image
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from typing import List, Union
 
+logger = logging.getLogger(__name__)
+
 def show_image(image, label):
     image = image.numpy()
     plt.title(f"Image of {label}")
@@ -21,19 +25,29 @@ def show_image(image, label):
 
 def entropy(p):
     """
-    Given a tensor p representing a probability distribution, returns the entropy of the distribution
+    Given a tensor p of shape [..., K] of probability distributions, returns the entropies along the last dim
+    """
+    return -(p * torch.log(p + 1e-7)).sum(dim=-1)
+
+def entropy_from_logits(x):
     """
-    return -torch.sum(p * torch.log(p + 1e-7))
+    Given a tensor x of shape [..., K] of unnormalized logits, returns the entropies of softmax(x) along the last dim,
+    computed as logsumexp(x) - sum(softmax(x) * x) without materializing the log-probabilities
+    """
+    return x.logsumexp(dim=-1) - (x.softmax(dim=-1) * x).sum(dim=-1)
+
+_INDEX_RE = re.compile(r'\d+')
 
 def get_index(path):
     """
-    Given a directory path, returns the highest index of the files in the directory or zero
+    Given a directory path, returns the highest index of the files in the directory plus one, or zero
+    Files without an index in their name are ignored
     """
     try:
-        files = os.listdir(path)
-        indices = [int(re.findall(r'\d+', file)[0]) for file in files]
-        return max(indices) + 1
-    except:
+        with os.scandir(path) as entries:
+            matches = (_INDEX_RE.search(entry.name) for entry in entries)
+            return max((int(match.group()) for match in matches if match), default=-1) + 1
+    except FileNotFoundError:
         return 0
 
 class ToUint8Transform:
@@ -43,33 +57,25 @@ class ToUint8Transform:
 
 
 class AugMix(torch.nn.Module):
+    """
+    AugMix backed by torchvision.transforms.AugMix, which runs the chains as tensor ops and mixes them in place.
+    Float images in [0, 1] are converted to uint8 for the torchvision ops and back, so the augmentation
+    runs on the device the images live on, for a single image [C, H, W] or a batch [B, C, H, W].
+    """
     def __init__(self, severity=3, width=3, depth=-1, alpha=1.):
         super(AugMix, self).__init__()
         self.severity = severity
         self.width = width
-        self.depth = depth if depth > 0 else np.random.randint(1, 3)
+        self.depth = depth
         self.alpha = alpha
-        # Define a list of transformations; these can be adjusted as needed
-        self.augmentations = [
-            transforms.ColorJitter(0.8*self.severity, 0.8*self.severity, 0.8*self.severity, np.clip(0.2*self.severity, -0.5, 0.5)),
-            transforms.RandomHorizontalFlip(),
-            transforms.RandomCrop(size=224, padding=int(224*0.125), pad_if_needed=True)
-        ]
+        self.to_uint8 = ToUint8Transform()
+        self.augmix = transforms.AugMix(severity=self.severity, mixture_width=self.width, chain_depth=self.depth, alpha=self.alpha)
         
     def forward(self, img):
-        ws = np.float32(np.random.dirichlet([self.alpha]*self.width))
-        m = np.float32(np.random.beta(self.alpha, self.alpha))
-        
-        mix = torch.zeros_like(img)
-        for i in range(self.width):
-            image_aug = img.clone()
-            for _ in range(self.depth):
-                op = random.choice(self.augmentations)
-                image_aug = op(image_aug)
-            mix += ws[i] * image_aug
-        
-        mixed = (1 - m) * img + m * mix
-        return mixed
+        if img.dtype == torch.uint8:
+            return self.augmix(img)
+        mixed = self.augmix(self.to_uint8(img))
+        return mixed.to(img.dtype).div_(255)
 
 class AverageMeter(object):
     """Computes and stores the average and current value"""
@@ -85,6 +91,23 @@ class AverageMeter(object):
         self.count = 0
 
     def update(self, val, n=1):
+        """
+        :param: val: torch.Tensor or float: tensors are accumulated on their device, without a sync
+        :param: n: int: number of samples val was averaged over
+        """
+        if not isinstance(val, torch.Tensor):
+            return self.update_scalar(val, n)
+        if not isinstance(self.sum, torch.Tensor):
+            # Lazily moved to the device of the first tensor update, keeping what was accumulated so far
+            self.sum = torch.tensor(self.sum, dtype=torch.float32, device=val.device)
+        self.val = val
+        self.sum.add_(val.detach() * n)
+        self.count += n
+
+    def update_scalar(self, val:float, n=1):
+        """
+        Fast path for python numbers
+        """
         self.val = val
         self.sum += val * n
         self.count += n
@@ -95,108 +118,220 @@ class AverageMeter(object):
         """
         if self.count == 0:
             return -1
-        return self.sum / self.count * 100.00
+        return float(self.sum) / self.count * 100.00
     
-def generate_augmented_batch(original_tensor, num_images, augmix_module):
-    batch = [original_tensor]  # Start with the original image
+class ClassAccuracyMeter(object):
+    """
+    Counts the correct predictions and the samples seen for every class name, reduced by compute_accuracies.
+    Class ids sharing a name (e.g. the two 'crane' of ImageNet) are pooled in the same slot
+    """
+    def __init__(self, id2classes: dict):
+        self.id2classes = id2classes
+        # Class names in order of first appearance and the slot of every class id
+        self.names = list(dict.fromkeys(id2classes.values()))
+        name2slot = {name: slot for slot, name in enumerate(self.names)}
+        self.id2slot = torch.zeros(max(id2classes) + 1, dtype=torch.long)
+        for idx, name in id2classes.items():
+            self.id2slot[idx] = name2slot[name]
+        self.correct = torch.zeros(len(self.names), dtype=torch.long)
+        self.total = torch.zeros(len(self.names), dtype=torch.long)
+
+    @classmethod
+    def from_meters(cls, id2classes: dict, class_meters: dict):
+        """
+        Builds the meter from a dict of per-class AverageMeter, as stored by older checkpoints
+        """
+        meter = cls(id2classes)
+        for slot, name in enumerate(meter.names):
+            meter.correct[slot] = int(class_meters[name].sum)
+            meter.total[slot] = class_meters[name].count
+        return meter
 
-    # Generate num_images-1 augmented images
-    for _ in range(num_images):
-        augmented_image = augmix_module(original_tensor.unsqueeze(0)).squeeze(0)
-        batch.append(augmented_image)
+    def update(self, targets: torch.Tensor, hits: torch.Tensor):
+        """
+        :param: targets: torch.Tensor: [B] class ids
+        :param: hits: torch.Tensor: [B] whether each prediction was correct
+        """
+        slots = self.id2slot[targets.cpu()]
+        self.total.scatter_add_(0, slots, torch.ones_like(slots))
+        self.correct.scatter_add_(0, slots, hits.cpu().long())
 
-    # Convert list of tensors to a single tensor
-    batch_tensor = torch.stack(batch)
-    return batch_tensor
+def generate_augmented_batch(original_tensor, num_images, augmix_module):
+    """
+    Returns the original image followed by num_images augmented views, [num_images+1, C, H, W].
+    torchvision's AugMix draws its ops once per call for the whole batch, so every view gets its own call
+    to keep the chains of the views independent
+    """
+    out = torch.empty((num_images+1, *original_tensor.shape), dtype=original_tensor.dtype, device=original_tensor.device)
+    out[0].copy_(original_tensor)
+
+    for i in range(num_images):
+        out[i+1].copy_(augmix_module(original_tensor))
+    return out
 
 def avg_entropy(outputs):
-    logits = outputs - outputs.logsumexp(dim=-1, keepdim=True) # logits = outputs.log_softmax(dim=1) [N, 1000]
-    avg_logits = logits.logsumexp(dim=0) - np.log(logits.shape[0]) # avg_logits = logits.mean(0) [1, 1000]
-    min_real = torch.finfo(avg_logits.dtype).min
-    avg_logits = torch.clamp(avg_logits, min=min_real)
-    return -(avg_logits * torch.exp(avg_logits)).sum(dim=-1)
+    """
+    Entropy of the average prediction over the views (dim -2), [N, K] -> scalar or [M, N, K] -> [M]
+    """
+    log_probs = outputs.log_softmax(dim=-1) # [N, 1000]
+    avg_log_probs = log_probs.logsumexp(dim=-2) - math.log(log_probs.shape[-2]) # log of the mean probabilities [1000]
+    avg_log_probs = avg_log_probs.clamp_min(torch.finfo(avg_log_probs.dtype).min)
+    return -(avg_log_probs * avg_log_probs.exp()).sum(dim=-1)
+
+
+_class_names_cache = (None, None)
+
+def _class_names(id2classes:dict) -> np.ndarray:
+    """
+    Returns the class names as an object array indexed by class id, built once per id2classes dict
+    :param: id2classes: dict: mapping from class index to class name
+    """
+    global _class_names_cache
+    cached_dict, class_names = _class_names_cache
+    if cached_dict is not id2classes:
+        class_names = np.empty(max(id2classes) + 1, dtype=object)
+        for idx, name in id2classes.items():
+            class_names[idx] = name
+        _class_names_cache = (id2classes, class_names)
+    return class_names
+
+CLIP_MEAN = torch.tensor([0.48145466, 0.4578275, 0.40821073]).reshape(1, 3, 1, 1)
+CLIP_STD = torch.tensor([0.26862954, 0.26130258, 0.27577711]).reshape(1, 3, 1, 1)
+
+_clip_stats = {}
+
+@torch.jit.script
+def _denormalize_kernel(images:torch.Tensor, mean:torch.Tensor, std:torch.Tensor) -> torch.Tensor:
+    # Denormalization, clamp and uint8 cast scripted together
+    return (images * std + mean).clamp_(0, 1).mul_(255).to(torch.uint8)
+
+def _denormalize(images:torch.Tensor) -> np.ndarray:
+    """
+    Undoes the CLIP normalization of a batch of images, the statistics are cached on every device
+    :param: images: torch.Tensor: [N, C, H, W] normalized images, left untouched
+    :return: np.ndarray: [N, H, W, C] uint8 images
+    """
+    if images.device not in _clip_stats:
+        _clip_stats[images.device] = (CLIP_MEAN.to(images.device), CLIP_STD.to(images.device))
+    denormalized = _denormalize_kernel(images.detach().float(), *_clip_stats[images.device])
+    return denormalized.permute(0, 2, 3, 1).cpu().numpy()
+
+
+def _log_io_error(future):
+    if future.exception() is not None:
+        logger.error("Background I/O failed", exc_info=future.exception())
+
+def run_io(io_pool, fn, *args):
+    """
+    Runs fn on the background I/O worker so that checkpointing and plotting do not stall the
+    test loop, synchronously if no worker is given
+    """
+    if io_pool is None:
+        fn(*args)
+    else:
+        io_pool.submit(fn, *args).add_done_callback(_log_io_error)
+
+# Reports can be rendered and saved by the background I/O worker, off the evaluation loop.
+# Only the Figure API is used there, the pyplot state machine is not thread safe
+_report_figs = {}
+
+def _get_report_fig(name:str, figsize, dpi=None) -> Figure:
+    """
+    Returns the cleared figure of a report, created on first use and then reused
+    """
+    if name not in _report_figs:
+        _report_figs[name] = Figure(figsize=figsize, dpi=dpi)
+        FigureCanvasAgg(_report_figs[name])
+    fig = _report_figs[name]
+    fig.clf()
+    return fig
 
 
 def batch_report(inputs:torch.Tensor, outputs: torch.Tensor, final_prediction:torch.Tensor,
-                 target:torch.Tensor, id2classes: dict, batch_n:int):
+                 target:torch.Tensor, id2classes: dict, batch_n:int, io_pool=None):
     """
     Creates a report in the batch_report/ dir showing augmentation images and their confidence
     Then shows the average confidence prediction
+    The tensors are copied to the CPU here, the figure is rendered and saved on io_pool if given
     :param: inputs: torch.Tensor: batch of images
     :param: outputs: torch.Tensor: batch of outputs
     :param: final_prediction: torch.Tensor: average prediction
     :param: target: torch.Tensor: batch with target label
     :param: id2classes: dict: mapping from class index to class name
     :param: batch_n: int: batch number
+    :param: io_pool: ThreadPoolExecutor: background I/O worker, the report is rendered synchronously if None
 
     TODO: Fix spacing in between images
     """
-    from matplotlib import pyplot as plt
     max_plots = 10
 
-    probabilities, predictions = outputs.cpu().topk(5)
-    probabilities = probabilities.detach().numpy()
-    predictions = predictions.detach()
-
-    clip_mean = [0.48145466, 0.4578275, 0.40821073]
-    clip_std = [0.26862954, 0.26130258, 0.27577711]
-
-    mean = torch.tensor(clip_mean).reshape(1, 3, 1, 1)
-    std = torch.tensor(clip_std).reshape(1, 3, 1, 1)
-
-    # Denormalize the batch of images
-    unnormalize = transforms.Normalize((-mean / std).tolist(), (1.0 / std).tolist())
-    denormalized_images = unnormalize(inputs)
-
-    # Visualise the input using matplotlib
-    images = [image.numpy().transpose(1, 2, 0) for image in denormalized_images.cpu()] # Convert to numpy and transpose to (H, W, C)
-
-    # Visualise the input using matplotlib
-    label = id2classes[target[0].item()]
+    # topk on the device, only the [max_plots, 5] results are copied to the CPU
+    probabilities, predictions = outputs[:max_plots].detach().topk(5)
+    avg_prob, avg_pred = final_prediction.detach().topk(5)
+    class_names = _class_names(id2classes)
+
+    report = dict(
+        # Denormalize the batch of images, (H, W, C) numpy images
+        images=_denormalize(inputs[:max_plots]),
+        probabilities=probabilities.float().cpu().numpy(),
+        labels=class_names[predictions.cpu().numpy()],
+        avg_prob=avg_prob.float().cpu().numpy(),
+        avg_labels=class_names[avg_pred.cpu().numpy()],
+        title=f"Image batch of {id2classes[target[0].item()]} - min entropy {max_plots} percentile selected\n{datetime.now()}",
+        path=f"batch_reports/Batch{batch_n}.png",
+    )
+    run_io(io_pool, _render_batch_report, report)
+
+def _render_batch_report(report:dict):
+    """
+    Draws and saves the figure of batch_report, runs on the background I/O worker
+    """
+    fig = _get_report_fig("batch_report", figsize=(16,16))
+    images, probabilities = report["images"], report["probabilities"]
 
-    plt.figure(figsize=(16,16))
-    plt.title(f"Image batch of {label} - min entropy {max_plots} percentile selected\n{datetime.now()}")
-    plt.axis('off')
+    ax = fig.add_subplot()
+    ax.set_title(report["title"])
+    ax.axis('off')
 
-    for i, image in enumerate(images[:max_plots]):
-        plt.subplot(6,4, 2*i+1)
-        plt.imshow(image)
-        plt.axis('off')
+    for i, image in enumerate(images):
+        ax = fig.add_subplot(6,4, 2*i+1)
+        ax.imshow(image)
+        ax.axis('off')
 
-        plt.subplot(6,4, 2*i+2)
+        ax = fig.add_subplot(6,4, 2*i+2)
         y = np.arange(probabilities.shape[-1])
-        plt.grid()
-        plt.barh(y, probabilities[i])
-        plt.gca().invert_yaxis()
-        plt.gca().set_axisbelow(True)
-        plt.yticks(y, [id2classes[pred] for pred in predictions[i].numpy()])
-        plt.xlabel("probability")
+        ax.grid()
+        ax.barh(y, probabilities[i])
+        ax.invert_yaxis()
+        ax.set_axisbelow(True)
+        ax.set_yticks(y)
+        ax.set_yticklabels(report["labels"][i])
+        ax.set_xlabel("probability")
     # Original image
-    plt.subplot(6,4, 22)
-    plt.imshow(images[0])
-    plt.axis('off')
-    plt.xlabel("Original image")
+    ax = fig.add_subplot(6,4, 22)
+    ax.imshow(images[0])
+    ax.axis('off')
+    ax.set_xlabel("Original image")
 
     # Final prediction
-    plt.subplot(6,4, 2*i+1)
-    plt.imshow(image)
-    plt.axis('off')
-    avg_prob, avg_pred = final_prediction.cpu().topk(5)
-    avg_prob = avg_prob.detach().numpy()
-    avg_pred = avg_pred.detach()
-    plt.subplot(6,4,23)
+    avg_prob = report["avg_prob"]
+    ax = fig.add_subplot(6,4,23)
     y = np.arange(avg_prob.shape[-1])
-    plt.grid()
-    plt.barh(y, avg_prob[0])
-    plt.gca().invert_yaxis()
-    plt.gca().set_axisbelow(True)
-    plt.yticks(y, [id2classes[index] for index in avg_pred[0].numpy()])
-    plt.xlabel("Final prediction (avg entropy)")    
+    ax.grid()
+    ax.barh(y, avg_prob[0])
+    ax.invert_yaxis()
+    ax.set_axisbelow(True)
+    ax.set_yticks(y)
+    ax.set_yticklabels(report["avg_labels"][0])
+    ax.set_xlabel("Final prediction (avg entropy)")    
 
-    plt.savefig(f"batch_reports/Batch{batch_n}.png")
-    plt.close()
+    fig.savefig(report["path"], bbox_inches=None)
 
-def make_histogram(no_tpt_acc: dict, tpt_acc: dict, no_tpt_label: str, tpt_label: str, save_path:str=None, worst_case=False)-> Image:
+HISTOGRAM_DPI = 150
+_histogram_fig = None
+_histogram_lock = threading.Lock()
+
+def make_histogram(no_tpt_acc: dict, tpt_acc: dict, no_tpt_label: str, tpt_label: str, save_path:str=None, worst_case=False, dpi:int=HISTOGRAM_DPI)-> np.ndarray:
     """
     Creates histogram for class accuracies and log it with tensorboard to save the plot
     :param: no_tpt_acc: dict: class accuracies before TPT
@@ -204,8 +339,9 @@ def make_histogram(no_tpt_acc: dict, tpt_acc: dict, no_tpt_label: str, tpt_label
     :param: no_tpt_label: str: label for the no_tpt_acc
     :param: tpt_label: str: label for the tpt_acc
     :param: save_path: str: path to save the plot. If None, the plot is not saved
+    :param: dpi: int: resolution of the plot
 
-    :return: PIL.Image: image of the plot
+    :return: np.ndarray: [H, W, 4] RGBA image of the plot
     """
 
     no_tpt_acc = {k: v for k, v in no_tpt_acc.items() if v != -1}
@@ -222,29 +358,42 @@ def make_histogram(no_tpt_acc: dict, tpt_acc: dict, no_tpt_label: str, tpt_label
         no_tpt_acc = worse_no_tpt_acc
         tpt_acc = worse_tpt_acc
             
+    # Figure API instead of pyplot, so that the histogram can be rendered by the background I/O worker.
+    # The figure is reused across calls, the lock protects it when it is also drawn synchronously
+    global _histogram_fig
+    with _histogram_lock:
+        if _histogram_fig is None:
+            _histogram_fig = Figure()
+            FigureCanvasAgg(_histogram_fig)
+        fig = _histogram_fig
+        fig.clf()
+        fig.set_dpi(dpi)
+        return _draw_histogram(fig, no_tpt_acc, tpt_acc, no_tpt_label, tpt_label, save_path)
+
+def _draw_histogram(fig, no_tpt_acc, tpt_acc, no_tpt_label, tpt_label, save_path):
+    """
+    Draws the histogram of make_histogram on the cleared fig and returns it as an image
+    """
     classes = list(no_tpt_acc.keys())
     x = np.arange(len(classes))
     width = 0.35    
 
-    fig, ax = plt.subplots(dpi=500)
+    ax = fig.subplots()
     ax.bar(x - width/2, no_tpt_acc.values(), width, color='b', label=no_tpt_label)
     ax.bar(x + width/2, tpt_acc.values(), width, color='r', label=tpt_label)
-    plt.legend()
+    ax.legend()
     
     ax.set_ylabel('Accuracy')
     ax.set_title('Class accuracies')
     ax.set_xticks(x)
     ax.set_xticklabels(classes, rotation=-90, fontsize=7.1-(len(classes)/200*7))
 
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png')
-    buf.seek(0)
-
-    image = Image.open(buf)
-    image = np.array(image)
+    # Read the RGBA pixels from the canvas, copied since the figure is reused. A png is only encoded to save the plot
+    fig.canvas.draw()
+    image = np.array(fig.canvas.buffer_rgba())
 
     if save_path:
-        plt.savefig(save_path)
+        fig.savefig(save_path, bbox_inches=None)
 
     return image
 
@@ -266,41 +415,55 @@ def report_predictions(idx:int, predictions:str, values:float, target:str):
             f.write(f"\t{pred}: {value:.2f}\n")
         f.write(f"{datetime.now()}")
 
-def compute_accuracies(no_tpt_class_acc:dict[AverageMeter], tpt_class_acc:dict[AverageMeter]):
+def compute_accuracies(no_tpt_class_acc:ClassAccuracyMeter, tpt_class_acc:ClassAccuracyMeter):
     """
     Computes the average accuracy for each class before and after TPT
-    :param: no_tpt_class_acc: dict: class accuracies before TPT
-    :param: tpt_class_acc: dict: class accuracies after TPT
+    :param: no_tpt_class_acc: ClassAccuracyMeter: class accuracies before TPT
+    :param: tpt_class_acc: ClassAccuracyMeter: class accuracies after TPT
 
     :return: dict, dict: no_tpt_accuracies, accuracies
     """
-    no_tpt_accuracies = {key: val.get_avg() for key, val in no_tpt_class_acc.items()}
-    accuracies = {key: val.get_avg() for key, val in tpt_class_acc.items()}
+    # Both meters are reduced at once, -1 for the classes without samples
+    correct = torch.stack([no_tpt_class_acc.correct, tpt_class_acc.correct]).float()
+    total = torch.stack([no_tpt_class_acc.total, tpt_class_acc.total])
+    class_accuracies = (correct / total.clamp_min(1) * 100.00).masked_fill_(total == 0, -1).tolist()
 
+    names = tpt_class_acc.names
+    no_tpt_accuracies, accuracies = (dict(zip(names, class_acc)) for class_acc in class_accuracies)
     return no_tpt_accuracies, accuracies
 
-def filter_on_entropy(inputs:torch.Tensor, outputs:torch.Tensor, p_percentile:int=10, return_original:bool=False):
+def filter_on_entropy(inputs:torch.Tensor, outputs:torch.Tensor, p_percentile:int=10, return_original:bool=False, from_logits:bool=False):
     """
     Return all inputs and outputs where prediction entropy is in the 'p' percentile
     :param: inputs: torch.Tensor: batch of inputs
     :param: outputs: torch.Tensor: batch of outputs
     :param: p_percentile: int: percentile threshold
     :param: return_original: bool: return the original image of the batch
-    """
-
-    p_threshold = np.percentile([entropy(t).item() for t in outputs], p_percentile)
-    entropies = [entropy(t).item() for t in outputs]
-    entropies = [0 if val > p_threshold else 1 for val in entropies]
-    indices = torch.nonzero(torch.tensor(entropies)).squeeze(1)
+    :param: from_logits: bool: outputs are unnormalized logits instead of probabilities
 
-    if return_original and 0 not in indices:
-        torch.cat((torch.tensor([0]), indices))
-
-    return inputs[indices], outputs[indices]
-
-def caption_report(images, image_logits, caption_logits, ice_scores, label, outputs, caption_prediction, id2class, idx):
+    If outputs has shape [M, N, K] (M images with N views each) the selection is done independently
+    for every image and the returned tensors have shape [M, k, ...]
+    """
+    entropies = entropy_from_logits(outputs) if from_logits else entropy(outputs) # [N] or [M, N]
+    # Same number of views selected by np.percentile with linear interpolation, the quantile is never
+    # materialized: the k lowest entropies are selected on the device, sorted only when the order is used
+    k = int((outputs.shape[-2] - 1) * p_percentile / 100) + 1
+    indices = torch.topk(entropies, k, dim=-1, largest=False, sorted=return_original).indices # [k] or [M, k]
+    if return_original:
+        # Swap the highest entropy selected view with the original one where it was left out
+        missing_original = (indices != 0).all(dim=-1) # [] or [M] boolean mask on the device
+        indices[..., -1].masked_fill_(missing_original, 0)
+
+    if outputs.dim() == 2:
+        return inputs.index_select(0, indices), outputs.index_select(0, indices)
+
+    rows = torch.arange(outputs.shape[0], device=indices.device).unsqueeze(1)
+    return inputs[rows, indices], outputs[rows, indices]
+
+def caption_report(images, image_logits, caption_logits, ice_scores, label, outputs, caption_prediction, id2class, idx, io_pool=None):
     """
     Generates a report for the captions generated by the model
+    The tensors are copied to the CPU here, the figure is rendered and saved on io_pool if given
     :param: images: torch.Tensor: batch of images
     
 
@@ -309,72 +472,85 @@ def caption_report(images, image_logits, caption_logits, ice_scores, label, outp
     :param: caption_prediction: torch.Tensor: average prediction from caption logits
     :param: id2class: dict: mapping from class index to class name
     :param: idx: int: index of the batch
+    :param: io_pool: ThreadPoolExecutor: background I/O worker, the report is rendered synchronously if None
     """
-    import matplotlib.pyplot as plt
+    max_plots = 9
+    class_names = _class_names(id2class)
 
-    ice_probabilities, ice_predictions = ice_scores.topk(5)
-    cap_probabilities = caption_logits.gather(1, ice_predictions)
-    img_probabilities = image_logits.gather(1, ice_predictions)
+    # topk and gathers on the device, the [3, B, 5] probabilities are copied to the CPU at once
+    ice_probabilities, ice_predictions = ice_scores[:max_plots].detach().topk(5)
+    cap_probabilities = caption_logits[:max_plots].detach().gather(1, ice_predictions)
+    img_probabilities = image_logits[:max_plots].detach().gather(1, ice_predictions)
 
-    ice_probabilities = ice_probabilities.cpu().detach()
-    ice_predictions = ice_predictions.cpu().detach()
-    cap_probabilities = cap_probabilities.cpu().detach()
-    img_probabilities = img_probabilities.cpu().detach()
+    probabilities = torch.stack([ice_probabilities, cap_probabilities, img_probabilities]).float().cpu().numpy()
     
     # Debugging purposes
     # with open(f"caption_reports/debug_{idx}.txt", 'w') as f:
     #     f.write('\nice_predictions:\n')
-    #     np.savetxt(f, ice_predictions.numpy(), fmt='%d')
+    #     np.savetxt(f, ice_predictions.cpu().numpy(), fmt='%d')
     #     f.write('ice_probabilities:\n')
-    #     np.savetxt(f, ice_probabilities.numpy(), fmt='%f')
+    #     np.savetxt(f, probabilities[0], fmt='%f')
     #     f.write('\ncap_probabilities:\n')
-    #     np.savetxt(f, cap_probabilities.numpy(), fmt='%f')
+    #     np.savetxt(f, probabilities[1], fmt='%f')
     #     f.write('\nimg_probabilities:\n')
-    #     np.savetxt(f, img_probabilities.numpy(), fmt='%f')
-
-    clip_mean = [0.48145466, 0.4578275, 0.40821073]
-    clip_std = [0.26862954, 0.26130258, 0.27577711]
+    #     np.savetxt(f, probabilities[2], fmt='%f')
 
-    mean = torch.tensor(clip_mean).reshape(1, 3, 1, 1)
-    std = torch.tensor(clip_std).reshape(1, 3, 1, 1)
-
-    # Denormalize the batch of images
-    unnormalize = transforms.Normalize((-mean / std).tolist(), (1.0 / std).tolist())
-    denormalized_images = unnormalize(images)
-
-    # Visualise the input using matplotlib
-    images = [image.numpy().transpose(1, 2, 0) for image in denormalized_images.cpu()] # Convert to numpy and transpose to (H, W, C)
     label = [lab.item() for lab in label.cpu()] if label.shape[0] > 1 else label.item()
+    if isinstance(label, list):
+        title = f"Captions generated from the {idx}th batch --- caption prediction {id2class[caption_prediction.item()]}"
+        image_titles = [id2class[lab] for lab in label[:max_plots]]
+    else:
+        title, image_titles = f"Caption for {id2class[label]} class", None
+
+    report = dict(
+        # Denormalize the batch of images, (H, W, C) numpy images
+        images=_denormalize(images[:max_plots]),
+        probabilities=probabilities,
+        labels=class_names[ice_predictions.cpu().numpy()],
+        captions=list(outputs[:max_plots]),
+        title=title,
+        image_titles=image_titles,
+        path=f"caption_reports/batch_{idx}.png",
+    )
+    run_io(io_pool, _render_caption_report, report)
+
+def _render_caption_report(report:dict):
+    """
+    Draws and saves the figure of caption_report, runs on the background I/O worker
+    """
+    fig = _get_report_fig("caption_report", figsize=(16, 16), dpi=300)
+    ice_probabilities, cap_probabilities, img_probabilities = report["probabilities"]
 
-    plt.figure(figsize=(16, 16), dpi=300)
-    plt.title(f"Captions generated from the {idx}th batch --- caption prediction {id2class[caption_prediction.item()]}") if isinstance(label, list) else plt.title(f"Caption for {id2class[label]} class")
-    plt.axis('off')
+    ax = fig.add_subplot()
+    ax.set_title(report["title"])
+    ax.axis('off')
 
-    for i, image in enumerate(images[:9]):
-        plt.subplot(6,4, 2*i+1)
+    for i, image in enumerate(report["images"]):
+        ax = fig.add_subplot(6,4, 2*i+1)
 
-        plt.title(id2class[label[i]]) if isinstance(label, list) else id2class[label]
-        plt.xlabel(outputs[i])
-        plt.imshow(image)
+        if report["image_titles"] is not None:
+            ax.set_title(report["image_titles"][i])
+        ax.set_xlabel(report["captions"][i])
+        ax.imshow(image)
 
-        plt.subplot(6,4, 2*i+2)
+        ax = fig.add_subplot(6,4, 2*i+2)
         width=0.35
         y = np.arange(ice_probabilities.shape[-1])
-        plt.grid()
-        plt.barh(y-width, ice_probabilities[i], width*2/3, color="green", label='ICE')
-        plt.barh(y, cap_probabilities[i], width*2/3, color="red", label='CAP')
-        plt.barh(y+width, img_probabilities[i], width*2/3, color="blue", label='IMG')
-        plt.gca().invert_yaxis()
-        plt.gca().set_axisbelow(True)
-        plt.yticks(y, [id2class[pred] for pred in ice_predictions[i].numpy()])
-        plt.xlim(0,1)
-        plt.xlabel("probability")
+        ax.grid()
+        ax.barh(y-width, ice_probabilities[i], width*2/3, color="green", label='ICE')
+        ax.barh(y, cap_probabilities[i], width*2/3, color="red", label='CAP')
+        ax.barh(y+width, img_probabilities[i], width*2/3, color="blue", label='IMG')
+        ax.invert_yaxis()
+        ax.set_axisbelow(True)
+        ax.set_yticks(y)
+        ax.set_yticklabels(report["labels"][i])
+        ax.set_xlim(0,1)
+        ax.set_xlabel("probability")
     
-    plt.legend()
-    plt.subplots_adjust(hspace=0.5)  # Increase vertical space between subplots
+    ax.legend()
+    fig.subplots_adjust(hspace=0.5)  # Increase vertical space between subplots
 
-    plt.savefig(f"caption_reports/batch_{idx}.png")
-    plt.close()
+    fig.savefig(report["path"], bbox_inches=None)
 
 def create_run_info(dataset_name, backbone, ice_loss, test_accuracy, run_name, ensamble_method):
     info = {